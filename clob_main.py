@@ -1,37 +1,116 @@
+from __future__ import annotations
+
+import argparse
+import bisect
+import io
+import multiprocessing
 import sys
-import heapq
-import time
-from decimal import Decimal
+import traceback
+import zlib
+from array import array
+from collections import deque
+from itertools import zip_longest
+from multiprocessing.connection import wait
+from typing import Any, ClassVar, Deque, Dict, Iterator, List, Optional, TextIO, Tuple, Type, TypeVar, Union, cast
+
+TICK_DECIMALS = 4
+# Level keys live in int64 arrays, negated for sellers, so ticks must stay within this range and a price of 1 must fit.
+MAX_TICKS = 2 ** 63 - 1
+MAX_TICK_DECIMALS = 18
+SHARD_BATCH_SIZE = 4096
+
+TRADE_FORMAT = "trade {}, {}, {}, {}\n"
+BOOK_HEADER = f"{'Buyers': <19}  Sellers"
+BUY_ROW_FORMAT = "{:<11,} {:<5} | "
+SELL_ROW_FORMAT = "{:<11} {:<11,}"
+EMPTY_BUY_ROW = " " * 23 + " | "
+EMPTY_SELL_ROW = " " * 23
+
+OrderT = TypeVar("OrderT", bound="Order")
+
+
+def to_ticks(price: bytes, decimals: int = TICK_DECIMALS) -> int:
+    """
+    Converts a raw decimal price field into an integer amount of ticks, so prices can be compared as plain ints.
+    """
+    whole, _, fraction = price.partition(b".")
+    if len(fraction) > decimals:
+        raise ValueError(f"Price {price.decode()} has more than {decimals} decimal places, see --tick-decimals")
+    ticks = int(whole + fraction.ljust(decimals, b"0"))
+    if not -MAX_TICKS <= ticks <= MAX_TICKS:
+        raise ValueError(f"Price {price.decode()} does not fit in 64-bit ticks, see --tick-decimals")
+    return ticks
+
+
+def format_price(ticks: int, decimals: int = TICK_DECIMALS) -> str:
+    """
+    Formats an amount of ticks back into a decimal price, omitting trailing zeros in the fractional part.
+    """
+    sign = "-" if ticks < 0 else ""
+    whole, fraction = divmod(abs(ticks), 10 ** decimals)
+    fraction = f"{fraction:0{decimals}d}".rstrip("0")
+    return f"{sign}{whole}.{fraction}" if fraction else f"{sign}{whole}"
 
 
 class Order:
     """
     A regular trade order
+    Filled orders are released into a per-class free list and reused by acquire, to avoid allocating a new object
+    for every incoming order.
     """
-    def __init__(self, id: str, price: Decimal, volume: int, type: str, timestamp: float):
+    __slots__ = ("id", "price", "volume", "type", "timestamp")
+    _pool: ClassVar[List[Any]] = []
+    is_iceberg: ClassVar[bool] = False
+
+    def __init__(self, id: str, price: int, volume: int, type: str, timestamp: int) -> None:
         self.id = id
         self.price = price
         self.volume = volume
         self.type = type
         self.timestamp = timestamp
 
-    def trade(self, amount, **kwargs) -> int:
-        possible_amount = min(self.volume, amount)
+    @classmethod
+    def acquire(cls: Type[OrderT], *args: Any) -> OrderT:
+        """
+        Builds an order reusing a released instance when available. Takes the same arguments as the constructor.
+        """
+        if not cls._pool:
+            return cls(*args)
+        order: OrderT = cls._pool.pop()
+        order.reinit(*args)
+        return order
+
+    def reinit(self, *args: Any) -> None:
+        """
+        Resets a released order with the constructor arguments. Calling __init__ again is not an option, as it is a
+        no-op on instances of mypyc-compiled classes.
+        """
+        self.id, self.price, self.volume, self.type, self.timestamp = args
+
+    def release(self) -> None:
+        """
+        Returns this order to its free list. It must no longer be referenced by the book.
+        """
+        type(self)._pool.append(self)
+
+    def trade(self, amount: int, matching_ts: int) -> int:
+        possible_amount = self.volume if self.volume < amount else amount
         self.volume -= possible_amount
         return possible_amount
 
-    def is_complete(self):
+    def is_complete(self) -> bool:
         return self.volume == 0
 
-    def should_restart(self):
+    def should_restart(self) -> bool:
         return False
 
     @property
-    def get_volume(self):
+    def get_volume(self) -> int:
         return self.volume
 
-    def __str__(self):
-        return f"{self.id} | {self.type} | {self.volume} | {self.price}"
+    def __str__(self) -> str:
+        # The tick precision belongs to the book, so the price is shown as raw ticks rather than guessing it.
+        return f"{self.id} | {self.type} | {self.volume} | {self.price} ticks"
 
 
 class IcebergOrder(Order):
@@ -39,12 +118,20 @@ class IcebergOrder(Order):
     Iceberg orders differ from Orders in that they have a recurring behaviour, related to their volume and
     visible quantity in the trade book.
     """
-    def __init__(self, id: str, price: Decimal, volume: int, type: str, timestamp: float, visible_quantity: int):
+    __slots__ = ("visible_quantity", "visible_volume")
+    _pool: ClassVar[List[Any]] = []
+    is_iceberg: ClassVar[bool] = True
+
+    def __init__(self, id: str, price: int, volume: int, type: str, timestamp: int, visible_quantity: int) -> None:
         self.visible_quantity = visible_quantity
         self.visible_volume = visible_quantity
         super().__init__(id, price, volume, type, timestamp)
 
-    def trade(self, amount, **kwargs) -> int:
+    def reinit(self, *args: Any) -> None:
+        super().reinit(*args[:-1])
+        self.visible_quantity = self.visible_volume = args[-1]
+
+    def trade(self, amount: int, matching_ts: int) -> int:
         """
         Iceberg orders need to know whether this trade is aggressive or passive.
         Passive trade presents a similar behaviour to regular orders, with the
@@ -52,31 +139,29 @@ class IcebergOrder(Order):
         Aggressive trading first consumes all prior matching orders, without having an
         impact on the visible_volume, unless the actual volume is less than the visible_quantity.
         :param amount: the amount intended to buy/sell from the other order.
-        :param kwargs: matching_order_timestamp should be supplied
+        :param matching_ts: the timestamp of the order this one is matched against
         :return: the actual amount that got transacted
         """
-        matching_order_timestamp = kwargs["matching_order_timestamp"]
-        is_aggressive = self.timestamp > matching_order_timestamp
-        if is_aggressive:
-            possible_amount = min(self.volume, amount)
+        if self.timestamp > matching_ts:
+            possible_amount = self.volume if self.volume < amount else amount
         else:
-            possible_amount = min(self.visible_volume, amount)
+            possible_amount = self.visible_volume if self.visible_volume < amount else amount
             self.visible_volume = self.visible_volume - possible_amount
         self.volume = self.volume - possible_amount
-        self.visible_volume = min(self.volume, self.visible_volume)
+        self.visible_volume = self.volume if self.volume < self.visible_volume else self.visible_volume
         return possible_amount
 
     def should_restart(self) -> bool:
         if self.visible_volume == 0 and self.volume > 0:
-            self.visible_volume = min(self.volume, self.visible_quantity)
+            self.visible_volume = self.volume if self.volume < self.visible_quantity else self.visible_quantity
             return True
         return False
 
     @property
-    def get_volume(self):
+    def get_volume(self) -> int:
         return self.visible_volume
 
-    def is_complete(self):
+    def is_complete(self) -> bool:
         return self.visible_volume == 0
 
 
@@ -84,82 +169,303 @@ class IcebergOrder(Order):
 class CLOB:
     """
     Central Limit Order Book
-    This class contains all the information regarding the orders book, as well as defining relative timestamps for
-    orders as they are processed and matched.
-    Buy and sell order books are represented with a heap. A match occurs each time the root of the buy heap price is
-    greater than or equal to the sell price of the root of the sell heap.
+    This class contains all the information regarding the orders book, as well as stamping orders with an increasing
+    sequence number as they are processed, which defines their time priority. Prices are kept as integer ticks.
+    Each side maps its price levels to FIFO deques of orders, and keeps the level prices in a sorted int64 array
+    (negated for sellers) whose last element is the best price. orders_book indexes resting orders by id.
     """
-    def __init__(self):
-        self.orders_book = {"B": {}, "S": {}}
-        self.buy_orders, self.sell_orders = [], []
-        self.epoch = time.time()
+    def __init__(self, out: Optional[TextIO] = None, tick_decimals: int = TICK_DECIMALS) -> None:
+        self.out: TextIO = out if out is not None else sys.stdout
+        self.tick_decimals = tick_decimals
+        self.orders_book: Dict[str, Dict[str, Order]] = {"B": {}, "S": {}}
+        self.buy_levels: Dict[int, Deque[Order]] = {}
+        self.sell_levels: Dict[int, Deque[Order]] = {}
+        self.buy_prices: array[int] = array("q")
+        self.sell_prices: array[int] = array("q")
+        self.seq = 0
 
+    def next_seq(self) -> int:
+        self.seq += 1
+        return self.seq
 
-    def get_timestamp(self):
-        return time.time() - self.epoch
+    def start_trades(self) -> None:
+        for line in sys.stdin.buffer.read().splitlines():
+            self.process_line(line)
 
-    def start_trades(self):
-        for line in sys.stdin.readlines():
-            fields = line.rstrip().split(",")
-            if len(fields) > 4:
-                order = IcebergOrder(fields[0], Decimal(fields[2]), int(fields[3]), fields[1], self.get_timestamp(),
-                                     int(fields[4]))
-            else:
-                order = Order(fields[0], Decimal(fields[2]), int(fields[3]), fields[1], self.get_timestamp())
-            self.orders_book[fields[1]][fields[0]] = order
-            if order.type == "S":
-                heapq.heappush(self.sell_orders, (order.price, order.timestamp, order.id))
-            else:
-                heapq.heappush(self.buy_orders, (-order.price, order.timestamp, order.id))
-            self.check_matches()
-
-    def check_matches(self):
-        match_log = {}
-        while self.buy_orders and self.sell_orders and -self.buy_orders[0][0] >= self.sell_orders[0][0]:
-            buy_order = self.orders_book["B"][self.buy_orders[0][2]]
-            sell_order = self.orders_book["S"][self.sell_orders[0][2]]
-            amount = buy_order.get_volume
-            traded_amount = sell_order.trade(amount, matching_order_timestamp=buy_order.timestamp)
-            if buy_order.timestamp > sell_order.timestamp:
-                match_key = (buy_order.id, sell_order.id, sell_order.price)
-            else:
-                match_key = (sell_order.id, buy_order.id, buy_order.price)
-            if match_key in match_log:
-                match_log[match_key][1] += traded_amount
+    def process_line(self, line: bytes) -> None:
+        fields = line.split(b",")
+        order_id, side, price = fields[0].decode(), fields[1].decode(), to_ticks(fields[2], self.tick_decimals)
+        order: Order
+        if len(fields) > 4:
+            order = IcebergOrder.acquire(order_id, price, int(fields[3]), side, self.next_seq(), int(fields[4]))
+        else:
+            order = Order.acquire(order_id, price, int(fields[3]), side, self.next_seq())
+        self.process_order(order)
+        # Only orders acquired here go back to the pool, the caller of process_order keeps ownership of its own.
+        if not order.volume:
+            order.release()
+
+    def add_order(self, order: Order) -> None:
+        self.orders_book[order.type][order.id] = order
+        if order.type == "S":
+            levels, prices, key = self.sell_levels, self.sell_prices, -order.price
+        else:
+            levels, prices, key = self.buy_levels, self.buy_prices, order.price
+        level = levels.get(order.price)
+        if level is None:
+            level = levels[order.price] = deque()
+            bisect.insort(prices, key)
+        level.append(order)
+
+    def cancel_order(self, order_id: str, side: str) -> None:
+        """
+        Removes a resting order from the book, wherever it sits. If its level becomes empty, the level key is found by
+        bisection in the sorted prices array and deleted in place.
+        :param order_id: the id of the order to cancel
+        :param side: "B" or "S", the side of the book the order rests on
+        """
+        order = self.orders_book[side].pop(order_id)
+        if side == "S":
+            levels, prices, key = self.sell_levels, self.sell_prices, -order.price
+        else:
+            levels, prices, key = self.buy_levels, self.buy_prices, order.price
+        level = levels[order.price]
+        level.remove(order)
+        if not level:
+            del levels[order.price]
+            del prices[bisect.bisect_left(prices, key)]
+        order.release()
+
+    def process_order(self, order: Order) -> None:
+        """
+        Matches an incoming order and rests whatever volume it has left in the book.
+        Orders that do not reach the best opposite price skip check_matches altogether. A filled order is left to the
+        caller rather than released to the pool.
+        """
+        if order.type == "B":
+            prices, limit = self.sell_prices, -order.price
+        else:
+            prices, limit = self.buy_prices, order.price
+        if prices and prices[-1] >= limit:
+            self.check_matches(order)
+        if order.volume:
+            self.add_order(order)
+
+    def check_matches(self, aggressor: Order) -> None:
+        """
+        Matches an incoming order against the opposite side of the book, best price level first.
+        The book is never left crossed, so every trade in a call has the incoming order as the aggressor and a
+        resting order as the passive side. That fixes the aggressor/passive roles for the whole loop: the aggressor
+        trades from its full volume whether or not it is an iceberg (its visible volume is capped once at the end),
+        and only the passive order is branched on by type. The loop checks Order.is_iceberg and reads volumes
+        directly instead of going through the polymorphic Order methods, since it runs once per match.
+        :param aggressor: the incoming order, not yet added to the book
+        """
+        if aggressor.type == "B":
+            side, levels, prices, sign = "S", self.sell_levels, self.sell_prices, -1
+        else:
+            side, levels, prices, sign = "B", self.buy_levels, self.buy_prices, 1
+        book, limit = self.orders_book[side], sign * aggressor.price
+        # Trades are aggregated per passive order. Dicts keep insertion order, so the log is already ordered by each
+        # order's first trade, even when an iceberg cycles back to the aggressor.
+        match_log: Dict[Tuple[str, int], int] = {}
+        timestamp, volume = aggressor.timestamp, aggressor.volume
+        while volume and prices and prices[-1] >= limit:
+            level = levels[sign * prices[-1]]
+            passive = level[0]
+            if passive.is_iceberg:
+                available = cast(IcebergOrder, passive).visible_volume
+                traded_amount = available if available < volume else volume
+                passive.trade(traded_amount, timestamp)
             else:
-                match_log[match_key] = [time.time(), traded_amount]
-            buy_order.trade(traded_amount, matching_order_timestamp=sell_order.timestamp)
-            if sell_order.is_complete():
-                heapq.heappop(self.sell_orders)
-                if sell_order.should_restart():
-                    heapq.heappush(self.sell_orders, (sell_order.price, self.get_timestamp(), sell_order.id))
-            if buy_order.is_complete():
-                heapq.heappop(self.buy_orders)
-                if buy_order.should_restart():
-                    heapq.heappush(self.buy_orders, (-buy_order.price, self.get_timestamp(), buy_order.id))
-        sorted_logs = list(match_log.items())
-        sorted_logs.sort(key=lambda x: x[1][0])
-        for log in sorted_logs:
-            print(f"trade {log[0][0]}, {log[0][1]}, {log[0][2]}, {log[1][1]}")
-
-    def print_output(self):
-        print(f"{'Buyers': <{19}}  Sellers")
-        while self.buy_orders or self.sell_orders:
-            order_line = ""
-            if self.buy_orders:
-                buy_order = self.orders_book["B"][heapq.heappop(self.buy_orders)[2]]
-                order_line += f"{buy_order.get_volume: <{11},} {buy_order.price: <{5}} | "
+                available = passive.volume
+                traded_amount = available if available < volume else volume
+                passive.volume -= traded_amount
+            volume -= traded_amount
+            match_key = (passive.id, passive.price)
+            match_log[match_key] = match_log.get(match_key, 0) + traded_amount
+            if traded_amount == available:
+                if passive.is_iceberg and passive.should_restart():
+                    # The restarted iceberg is the head of its level, a single rotation moves it to the back.
+                    level.rotate(-1)
+                else:
+                    level.popleft()
+                    del book[passive.id]
+                    passive.release()
+                    if not level:
+                        del levels[passive.price]
+                        prices.pop()
+        aggressor.volume = volume
+        if aggressor.is_iceberg and volume < cast(IcebergOrder, aggressor).visible_volume:
+            cast(IcebergOrder, aggressor).visible_volume = volume
+        if match_log:
+            decimals = self.tick_decimals
+            self.out.write("".join(TRADE_FORMAT.format(aggressor.id, passive_id, format_price(price, decimals), traded)
+                                   for (passive_id, price), traded in match_log.items()))
+
+    @staticmethod
+    def iter_orders(levels: Dict[int, Deque[Order]], prices: array[int], sign: int) -> Iterator[Order]:
+        for key in reversed(prices):
+            yield from levels[sign * key]
+
+    def print_output(self) -> None:
+        lines = [BOOK_HEADER]
+        decimals = self.tick_decimals
+        buy_orders = self.iter_orders(self.buy_levels, self.buy_prices, 1)
+        sell_orders = self.iter_orders(self.sell_levels, self.sell_prices, -1)
+        for buy_order, sell_order in zip_longest(buy_orders, sell_orders):
+            if buy_order is not None:
+                order_line = BUY_ROW_FORMAT.format(buy_order.get_volume, format_price(buy_order.price, decimals))
             else:
-                order_line += f"{'': <{11}} {'': <{11}} | "
-            if self.sell_orders:
-                sell_order = self.orders_book["S"][heapq.heappop(self.sell_orders)[2]]
-                order_line += f"{sell_order.price: <{11}} {sell_order.get_volume: <{11},}"
+                order_line = EMPTY_BUY_ROW
+            if sell_order is not None:
+                order_line += SELL_ROW_FORMAT.format(format_price(sell_order.price, decimals), sell_order.get_volume)
             else:
-                order_line += f"{'': <{11}} {'': <{11}}"
-            print(order_line)
+                order_line += EMPTY_SELL_ROW
+            lines.append(order_line)
+        self.out.write("\n".join(lines) + "\n")
+
+
+# A book's (symbol, output) once a shard is done, or the traceback of a failed shard.
+ShardResult = Union[Tuple[bytes, str], str]
+
+
+class Shard(multiprocessing.Process):
+    """
+    Runs the order books of a subset of symbols in a separate process.
+    Orders arrive in batches of (symbol, order line) pairs through the orders pipe, and each symbol is matched by its
+    own CLOB on the shard's single thread, so the orders of a symbol are always processed in arrival order without
+    locking. Once the None sentinel arrives, every book is printed and sent back as (symbol, output) through the
+    results pipe, followed by a None marking the shard as done. If anything fails, the shard keeps draining its orders,
+    so the dispatcher never blocks on it, and sends the formatted traceback instead of the None.
+    """
+    def __init__(self, tick_decimals: int = TICK_DECIMALS) -> None:
+        super().__init__(daemon=True)
+        self.orders_receiver, self.orders = multiprocessing.Pipe(duplex=False)
+        self.results, self.results_sender = multiprocessing.Pipe(duplex=False)
+        self.tick_decimals = tick_decimals
+
+    def submit(self, batch: Optional[List[Tuple[bytes, bytes]]]) -> bool:
+        """
+        Sends a batch of orders, or the None sentinel, to the shard.
+        :return: False if the shard has exited and can no longer receive it
+        """
+        try:
+            self.orders.send(batch)
+        except (BrokenPipeError, ConnectionResetError):
+            return False
+        return True
+
+    def run(self) -> None:
+        books: Dict[bytes, CLOB] = {}
+        failure: Optional[str] = None
+        while (batch := self.orders_receiver.recv()) is not None:
+            if failure is not None:
+                continue
+            try:
+                for symbol, line in batch:
+                    clob = books.get(symbol)
+                    if clob is None:
+                        clob = books[symbol] = CLOB(io.StringIO(), self.tick_decimals)
+                    clob.process_line(line)
+            except Exception:
+                failure = traceback.format_exc()
+        if failure is None:
+            try:
+                for symbol, clob in books.items():
+                    clob.print_output()
+                    self.results_sender.send((symbol, cast(io.StringIO, clob.out).getvalue()))
+            except Exception:
+                failure = traceback.format_exc()
+        self.results_sender.send(failure)
+
+
+def start_sharded_trades(shards_count: int, tick_decimals: int = TICK_DECIMALS) -> None:
+    """
+    Reads symbol prefixed order lines (symbol,id,side,price,volume[,visible]) from standard input and routes each
+    symbol to one of shards_count Shard processes by hashing it. Only the symbol field is parsed here.
+    The output of every book is written once all shards are done, under a line with its symbol, in the order in
+    which the symbols first appeared. Raises RuntimeError if a shard fails or exits without reporting.
+    """
+    shards: List[Shard] = []
+    for _ in range(shards_count):
+        # Each shard is created only once the previous ones are started and their ends closed, so no shard inherits the
+        # pipe ends of another one.
+        shard = Shard(tick_decimals)
+        shard.start()
+        # Only the shard reads orders and writes results. Dropping the parent's copies makes sending orders to a dead
+        # shard fail instead of blocking once the pipe is full, and its results pipe hit EOF.
+        shard.orders_receiver.close()
+        shard.results_sender.close()
+        shards.append(shard)
+    # A shard that can no longer receive orders is skipped from then on, the results loop reports it as failed.
+    receiving = [True] * shards_count
+    batches: List[List[Tuple[bytes, bytes]]] = [[] for _ in shards]
+    symbols: Dict[bytes, None] = {}
+    for line in sys.stdin.buffer.read().splitlines():
+        symbol, _, order_line = line.partition(b",")
+        symbols.setdefault(symbol, None)
+        index = zlib.crc32(symbol) % shards_count
+        batch = batches[index]
+        batch.append((symbol, order_line))
+        if len(batch) == SHARD_BATCH_SIZE:
+            if receiving[index]:
+                receiving[index] = shards[index].submit(batch)
+            batches[index] = []
+    for index, (shard, batch) in enumerate(zip(shards, batches)):
+        if batch and receiving[index]:
+            receiving[index] = shard.submit(batch)
+        if receiving[index]:
+            shard.submit(None)
+    outputs: Dict[bytes, str] = {}
+    failures: List[str] = []
+    pending = {shard.results: shard for shard in shards}
+    while pending:
+        ready = wait([*pending, *(shard.sentinel for shard in pending.values())])
+        for results, shard in list(pending.items()):
+            # Drain whatever the shard sent before looking at its exit, as it may exit right after reporting.
+            exited = shard.sentinel in ready
+            try:
+                while results.poll():
+                    result: Optional[ShardResult] = results.recv()
+                    if isinstance(result, tuple):
+                        outputs[result[0]] = result[1]
+                    else:
+                        del pending[results]
+                        if result is not None:
+                            failures.append(result)
+                        break
+            except EOFError:
+                exited = True
+            if exited and results in pending:
+                del pending[results]
+                shard.join()
+                failures.append(f"{shard.name} exited with code {shard.exitcode} without reporting its books\n")
+    for shard in shards:
+        shard.join()
+    if failures:
+        raise RuntimeError(f"{len(failures)} shard(s) failed, first error:\n{failures[0]}")
+    sys.stdout.write("".join(f"{symbol.decode()}\n{outputs[symbol]}" for symbol in symbols))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Central Limit Order Book reading orders from standard input")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="match one book per symbol across this many processes; input lines are then "
+                             "prefixed with a symbol column")
+    parser.add_argument("--tick-decimals", type=int, default=TICK_DECIMALS,
+                        help=f"decimal places of the price tick (default: {TICK_DECIMALS}); prices with more "
+                             "decimal places are rejected, as are prices beyond 64-bit ticks")
+    args = parser.parse_args()
+    if not 0 <= args.tick_decimals <= MAX_TICK_DECIMALS:
+        parser.error(f"--tick-decimals must be between 0 and {MAX_TICK_DECIMALS}")
+    if args.shards > 0:
+        start_sharded_trades(args.shards, args.tick_decimals)
+    else:
+        clob = CLOB(tick_decimals=args.tick_decimals)
+        clob.start_trades()
+        clob.print_output()
 
 
 if __name__ == "__main__":
-    clob = CLOB()
-    clob.start_trades()
-    clob.print_output()
+    main()
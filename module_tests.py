@@ -1,55 +1,207 @@
+import io
+import os
+import subprocess
+import sys
 import time
 import unittest
-from decimal import Decimal
 
-from clob_main import Order, IcebergOrder
+from clob_main import CLOB, Order, IcebergOrder, to_ticks, format_price
+
+CLOB_MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clob_main.py")
 
 
 class TestOrders(unittest.TestCase):
 
     def test_order_not_completed(self):
-        order = Order("1", Decimal("100.1"), 100, "B", time.time())
+        order = Order("1", 1001000, 100, "B", time.monotonic_ns())
         assert not order.is_complete()
 
     def test_order_completed(self):
-        order = Order("1", Decimal("100.1"), 100, "B", time.time())
-        amount = order.trade(100)
+        order = Order("1", 1001000, 100, "B", time.monotonic_ns())
+        amount = order.trade(100, time.monotonic_ns())
         assert amount == 100
         assert order.is_complete()
         assert not order.should_restart()
 
     def test_order_should_not_restart(self):
-        order = Order("1", Decimal("100.1"), 100, "B", time.time())
+        order = Order("1", 1001000, 100, "B", time.monotonic_ns())
         assert not order.should_restart()
 
+    def test_released_order_is_reused_by_acquire(self):
+        order = Order.acquire("1", 1001000, 100, "B", 1)
+        order.release()
+        reused = Order.acquire("2", 1002000, 50, "S", 2)
+        assert reused is order
+        assert (reused.id, reused.price, reused.volume, reused.type, reused.timestamp) == ("2", 1002000, 50, "S", 2)
+        assert IcebergOrder._pool is not Order._pool
+
 
 class TestIcebergOrders(unittest.TestCase):
 
     def test_iceberg_order_not_completed(self):
-        order = IcebergOrder("1", Decimal("100.1"), 100, "B", time.time(), 10)
+        order = IcebergOrder("1", 1001000, 100, "B", time.monotonic_ns(), 10)
         assert not order.is_complete()
 
     def test_iceberg_order_get_volume_property_returns_visible_volume(self):
-        order = IcebergOrder("1", Decimal("100.1"), 100, "B", time.time(), 10)
+        order = IcebergOrder("1", 1001000, 100, "B", time.monotonic_ns(), 10)
         assert order.get_volume == 10
 
     def test_iceberg_order_should_restart(self):
-        order = IcebergOrder("1", Decimal("100.1"), 100, "B", time.time(), 10)
-        amount = order.trade(20, matching_order_timestamp=time.time())
+        order = IcebergOrder("1", 1001000, 100, "B", time.monotonic_ns(), 10)
+        amount = order.trade(20, time.monotonic_ns())
         assert amount == 10
         assert order.is_complete()
         assert order.should_restart()
 
+    def test_aggressive_iceberg_trade_keeps_visible_volume(self):
+        order = IcebergOrder("1", 1001000, 100, "B", 2, 10)
+        amount = order.trade(25, 1)
+        assert amount == 25
+        assert (order.volume, order.visible_volume) == (75, 10)
+        amount = order.trade(100, 1)
+        assert amount == 75
+        assert order.is_complete()
+
     def test_iceberg_order_full_should_not_restart_after_complete(self):
-        order = IcebergOrder("1", Decimal("100.1"), 20, "B", time.time(), 10)
-        amount = order.trade(10, matching_order_timestamp=time.time())
+        order = IcebergOrder("1", 1001000, 20, "B", time.monotonic_ns(), 10)
+        amount = order.trade(10, time.monotonic_ns())
         assert amount == 10
         assert order.should_restart()
-        amount = order.trade(10, matching_order_timestamp=time.time())
+        amount = order.trade(10, time.monotonic_ns())
         assert amount == 10
         assert order.is_complete()
         assert not order.should_restart()
 
 
+class TestPriceTicks(unittest.TestCase):
+
+    def test_to_ticks_scales_decimal_price(self):
+        assert to_ticks(b"100") == 1000000
+        assert to_ticks(b"100.1") == 1001000
+        assert to_ticks(b"-0.25") == -2500
+
+    def test_to_ticks_rejects_prices_finer_than_a_tick(self):
+        with self.assertRaises(ValueError):
+            to_ticks(b"100.00001")
+
+    def test_to_ticks_rejects_prices_beyond_64_bits(self):
+        assert to_ticks(b"9.223372036854775807", 18) == 2 ** 63 - 1
+        with self.assertRaises(ValueError):
+            to_ticks(b"100000000", 12)
+
+    def test_format_price_round_trips(self):
+        for price in ("100", "100.1", "0.0001", "-0.25"):
+            assert format_price(to_ticks(price.encode())) == price
+
+
+class TestCLOB(unittest.TestCase):
+
+    def test_filled_level_is_removed_and_rest_stays_queued(self):
+        clob = CLOB(io.StringIO())
+        clob.add_order(Order("1", 1000000, 100, "S", 1))
+        clob.add_order(Order("2", 1000000, 50, "S", 2))
+        clob.add_order(Order("3", 1010000, 50, "S", 3))
+        clob.process_order(Order("4", 1000000, 150, "B", 4))
+        assert clob.out.getvalue() == "trade 4, 1, 100, 100\ntrade 4, 2, 100, 50\n"
+        assert 1000000 not in clob.sell_levels and not clob.buy_levels
+        assert list(clob.sell_prices) == [-1010000]
+        assert list(clob.orders_book["S"]) == ["3"] and not clob.orders_book["B"]
+
+    def test_filled_caller_order_is_not_pooled(self):
+        clob = CLOB(io.StringIO())
+        clob.process_line(b"1,S,100,5")
+        aggressor = Order("2", 1000000, 5, "B", 2)
+        clob.process_order(aggressor)
+        assert aggressor not in Order._pool
+        assert clob.orders_book["S"] == {} and not clob.sell_levels
+
+    def test_restarted_iceberg_goes_to_the_back_of_its_level(self):
+        clob = CLOB(io.StringIO())
+        clob.add_order(IcebergOrder("ice", 1000000, 100, "B", 1, 10))
+        clob.add_order(Order("2", 1000000, 50, "B", 2))
+        clob.process_order(Order("3", 1000000, 10, "S", 3))
+        assert [order.id for order in clob.buy_levels[1000000]] == ["2", "ice"]
+
+    def test_order_str_shows_raw_ticks(self):
+        clob = CLOB(io.StringIO(), tick_decimals=6)
+        clob.process_line(b"1,S,100,5")
+        assert str(clob.orders_book["S"]["1"]) == "1 | S | 5 | 100000000 ticks"
+
+    def test_tick_decimals_sets_price_precision(self):
+        clob = CLOB(io.StringIO(), tick_decimals=6)
+        clob.process_line(b"1,S,100.00001,5")
+        clob.process_line(b"2,B,100.00002,5")
+        assert clob.out.getvalue() == "trade 2, 1, 100.00001, 5\n"
+        with self.assertRaises(ValueError):
+            CLOB(io.StringIO()).process_line(b"1,S,100.00001,5")
+
+    def test_cancel_order_drops_an_inner_level(self):
+        clob = CLOB(io.StringIO())
+        for order_id, price in (("1", 990000), ("2", 980000), ("3", 970000)):
+            clob.add_order(Order(order_id, price, 10, "B", int(order_id)))
+        clob.cancel_order("2", "B")
+        assert list(clob.buy_prices) == [970000, 990000]
+        assert 980000 not in clob.buy_levels and "2" not in clob.orders_book["B"]
+
+    def test_cancel_order_keeps_the_rest_of_its_level_queued(self):
+        clob = CLOB(io.StringIO())
+        for order_id in ("1", "2", "3"):
+            clob.add_order(Order(order_id, 1000000, 10, "S", int(order_id)))
+        clob.cancel_order("2", "S")
+        assert [order.id for order in clob.sell_levels[1000000]] == ["1", "3"]
+        assert list(clob.sell_prices) == [-1000000]
+
+    def test_aggressive_iceberg_rests_with_capped_visible_volume(self):
+        clob = CLOB(io.StringIO())
+        clob.add_order(Order("1", 1000000, 25, "S", 1))
+        aggressor = IcebergOrder("ice", 1000000, 30, "B", 2, 10)
+        clob.process_order(aggressor)
+        assert clob.out.getvalue() == "trade ice, 1, 100, 25\n"
+        assert list(clob.buy_levels[1000000]) == [aggressor]
+        assert (aggressor.volume, aggressor.visible_volume) == (5, 5)
+
+
+class TestShardedTrades(unittest.TestCase):
+
+    def run_clob(self, orders, *args):
+        return subprocess.run([sys.executable, CLOB_MAIN, *args], input="\n".join(orders).encode(),
+                              capture_output=True, check=True).stdout.decode()
+
+    def test_each_symbol_matches_as_its_own_book(self):
+        aaa = ["1,S,100,50", "2,B,101,80", "3,S,101,10"]
+        bbb = ["4,B,99,20", "5,S,99,5", "ice,S,98,40,10"]
+        mixed = ["AAA," + aaa[0], "BBB," + bbb[0], "BBB," + bbb[1], "AAA," + aaa[1], "BBB," + bbb[2], "AAA," + aaa[2]]
+        expected = "AAA\n" + self.run_clob(aaa) + "BBB\n" + self.run_clob(bbb)
+        assert self.run_clob(mixed, "--shards", "2") == expected
+
+    def run_failing_shards(self, patch, orders=("AAA,1,S,100,5", "BBB,2,B,99,5")):
+        script = ("import multiprocessing, os, clob_main\n"
+                  "multiprocessing.set_start_method('fork')\n"
+                  f"clob_main.CLOB.{patch}\n"
+                  "clob_main.main()\n")
+        return subprocess.run([sys.executable, "-c", script, "--shards", "2"], input="\n".join(orders).encode(),
+                              capture_output=True, cwd=os.path.dirname(CLOB_MAIN), timeout=60)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs the fork start method")
+    def test_shard_failing_after_matching_is_reported(self):
+        result = self.run_failing_shards("print_output = lambda self: 1 / 0")
+        assert result.returncode != 0
+        assert b"ZeroDivisionError" in result.stderr and b"shard(s) failed" in result.stderr
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs the fork start method")
+    def test_shard_dying_without_reporting_is_reported(self):
+        result = self.run_failing_shards("print_output = lambda self: os._exit(3)")
+        assert result.returncode != 0
+        assert b"exited with code 3 without reporting" in result.stderr
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs the fork start method")
+    def test_shard_dying_while_being_fed_is_reported(self):
+        # Far more input than a pipe buffer holds, so the dispatcher is still sending when the shard dies.
+        orders = [f"AAA,{order_id},S,100,5" for order_id in range(200000)]
+        result = self.run_failing_shards("process_line = lambda self, line: os._exit(3)", orders)
+        assert result.returncode != 0
+        assert b"exited with code 3 without reporting" in result.stderr
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,7 @@
+"""
+Entry point importing clob_main as a module, so that a mypyc-compiled build of it is picked up when present.
+"""
+from clob_main import main
+
+if __name__ == "__main__":
+    main()